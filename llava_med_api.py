@@ -3,13 +3,19 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 import httpx
 import base64
-import io
-from PIL import Image
-import json
-import hashlib
+import simplejpeg
+import cv2
+import numpy as np
+import orjson
+import xxhash
 import logging
+import time
 import re
-from google.cloud import translate
+import asyncio
+import collections
+import contextlib
+from cachetools import TTLCache
+from google.cloud.translate_v3 import TranslationServiceAsyncClient
 
 
 app = FastAPI()
@@ -29,79 +35,284 @@ app.add_middleware(
 
 CONTROLLER_ADDRESS = "http://localhost:10000"  # Replace with your controller's address
 WORKER_TIMEOUT = 60.0  # Increased timeout
+CONTROLLER_TIMEOUT = 5.0  # Address lookups are quick; keep a hung controller from stalling requests
+MODEL_NAME = "llava-med-v1.5-mistral-7b"
+# Generation settings shared by every worker request; per-request fields are merged in
+BASE_PAYLOAD = {
+    "model": MODEL_NAME,
+    "temperature": 0.2,
+    "top_p": 0.7,
+    "max_new_tokens": 512,
+    "stop": "</s>",
+}
+JSON_HEADERS = {"Content-Type": "application/json"}  # Payloads are pre-serialized with orjson
+UPLOAD_CHUNK_BYTES = 65535  # Multiple of 3, so each chunk base64-encodes without padding
+WORKER_ADDRESS_TTL = 30.0  # Seconds to reuse a worker address before asking the controller again
+PROJECT_ID = "apt-market-430913-t8"
+TRANSLATE_PARENT = f"projects/{PROJECT_ID}/locations/global"
+SENTENCE_END = re.compile(r'[.!?]\s+')  # Boundary at which streamed text is sent for translation
+SSE_LINE_BREAK = re.compile(r'\r\n|\r|\n')  # Line terminators that would split an SSE data field
 
-# Initialize Translation client
-def translate_text(
-    text: str, project_id: str = "apt-market-430913-t8"
-    ):
+# (image_hash, prompt) -> translated stream events, and generated text -> translated text
+response_cache = TTLCache(maxsize=1024, ttl=3600)
+translation_cache = TTLCache(maxsize=1024, ttl=3600)
+cache_lock = asyncio.Lock()
 
-    client = translate.TranslationServiceClient()
+# model -> (worker address, time it was resolved)
+worker_addresses = {}
+worker_address_lock = asyncio.Lock()
 
-    location = "global"
+@app.on_event("startup")
+async def startup():
+    # Shared client so worker/controller connections are kept alive between requests
+    app.state.http = httpx.AsyncClient(
+        timeout=httpx.Timeout(WORKER_TIMEOUT),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=300),
+    )
+    # Async gRPC client, created inside the running loop and reused for every translation
+    app.state.translate = TranslationServiceAsyncClient()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.http.aclose()
+    await app.state.translate.transport.close()
 
-    parent = f"projects/{project_id}/locations/{location}"
+async def translate_text(contents: list) -> list:
+    # Accepts several texts so callers can translate them in a single RPC
+    client = app.state.translate
 
     # Translate text from English to French
     # Detail on supported types can be found here:
     # https://cloud.google.com/translate/docs/supported-formats
-    response = client.translate_text(
+    response = await client.translate_text(
         request={
-            "parent": parent,
-            "contents": [text],
+            "parent": TRANSLATE_PARENT,
+            "contents": contents,
             "mime_type": "text/plain",  # mime types: text/plain, text/html
             "source_language_code": "en-US",
             "target_language_code": "id",
         }
     )
 
-    # Display the translation for each input text provided
-    for translation in response.translations:
-        return translation.translated_text
+    # Translations come back in the same order as the input texts
+    return [translation.translated_text for translation in response.translations]
+
+async def translate_text_cached(text: str) -> str:
+    async with cache_lock:
+        translated_text = translation_cache.get(text)
+    if translated_text is None:
+        translations = await translate_text([text])
+        translated_text = translations[0] if translations else None
+        if translated_text is not None:
+            async with cache_lock:
+                translation_cache[text] = translated_text
+    return translated_text
 
 async def get_worker_address(model: str) -> str:
-    async with httpx.AsyncClient() as client:
+    cached = worker_addresses.get(model)
+    if cached is not None and time.monotonic() - cached[1] < WORKER_ADDRESS_TTL:
+        return cached[0]
+
+    # The lock makes concurrent callers on a cache miss share a single controller refresh
+    async with worker_address_lock:
+        cached = worker_addresses.get(model)
+        if cached is not None and time.monotonic() - cached[1] < WORKER_ADDRESS_TTL:
+            return cached[0]
+
+        client = app.state.http
         try:
-            response = await client.post(f"{CONTROLLER_ADDRESS}/get_worker_address", json={"model": model})
+            response = await client.post(f"{CONTROLLER_ADDRESS}/get_worker_address", json={"model": model}, timeout=CONTROLLER_TIMEOUT)
             response.raise_for_status()
-            return response.json()["address"]
+            address = response.json()["address"]
         except httpx.HTTPError as e:
             logger.error(f"Failed to get worker address: {str(e)}")
             raise HTTPException(status_code=503, detail="Failed to get worker address from controller")
 
-async def process_image(image: UploadFile) -> tuple:
-    image_content = await image.read()
-    image = Image.open(io.BytesIO(image_content)).convert('RGB')
-    image_hash = hashlib.md5(image.tobytes()).hexdigest()
+        worker_addresses[model] = (address, time.monotonic())
+        return address
+
+def jpeg_colorspace(head: bytes):
+    # None for non-JPEG uploads, or when the header did not fit in the first chunk
+    if head[:3] != b'\xff\xd8\xff':
+        return None
+    try:
+        return simplejpeg.decode_jpeg_header(head)[2]
+    except ValueError:
+        return None
+
+def encode_image(image_file) -> tuple:
+    # Hash the compressed upload rather than the decoded pixel buffer
+    hasher = xxhash.xxh3_128()
+    head = image_file.read(UPLOAD_CHUNK_BYTES)
+    hasher.update(head)
+    colorspace = jpeg_colorspace(head)
+    if colorspace in ('YCbCr', 'RGB'):
+        # Already an RGB JPEG: the worker accepts it as-is, so stream it through the hash and
+        # base64 encoder rather than reading the raw upload into memory first
+        base64_image = bytearray(base64.b64encode(head))
+        while chunk := image_file.read(UPLOAD_CHUNK_BYTES):
+            hasher.update(chunk)
+            base64_image += base64.b64encode(chunk)
+        # Returned as the bytearray itself, converting to bytes would copy the whole blob again
+        return hasher.hexdigest(), base64_image
+
+    rest = image_file.read()
+    hasher.update(rest)
+    image_hash = hasher.hexdigest()
+    image_content = head + rest
+
+    # The worker expects a 3-channel RGB image, so anything else is decoded and re-encoded
+    if colorspace == 'Gray':
+        # Grayscale JPEGs (most X-ray/CT images) are expanded to RGB by simplejpeg directly
+        rgb = simplejpeg.decode_jpeg(image_content, colorspace='RGB')
+    else:
+        # CMYK JPEG, PNG and other formats go through OpenCV, which decodes to BGR. EXIF
+        # orientation is ignored, as on the passthrough path, so no upload gets rotated
+        bgr = cv2.imdecode(np.frombuffer(image_content, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if bgr is None:
+            raise ValueError("Unsupported image format")
+        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
     
-    buffer = io.BytesIO()
-    image.save(buffer, format="JPEG")
-    base64_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    jpeg_bytes = simplejpeg.encode_jpeg(rgb, quality=85, colorspace='RGB')
+    base64_image = base64.b64encode(jpeg_bytes)
     
     return image_hash, base64_image
 
-async def stream_generator(worker_address: str, payload: dict):
-    async with httpx.AsyncClient() as client:
-        async with client.stream('POST', f"{worker_address}/worker_generate_stream", json=payload, timeout=WORKER_TIMEOUT) as response:
-            response.raise_for_status()
-            async for line in response.aiter_lines():
-                if line:
-                    logger.debug(f"Received line from worker: {line}")
-                    try:
-                        data = json.loads(line)
-                        if "error_code" in data:
-                            if data["error_code"] == 0 and "text" in data:
-                                yield f"data: {data['text']}\n\n"
-                            else:
-                                logger.error(f"Received error from worker: {data}")
-                                yield f"data: Error: {data.get('text', 'Unknown error')}\n\n"
-                        else:
-                            logger.warning(f"Received JSON data without 'error_code' field: {data}")
-                    except json.JSONDecodeError:
-                        logger.warning(f"Received non-JSON line, treating as raw text: {line}")
-                        yield f"data: {line.strip()}\n\n"
-                    except Exception as e:
-                        logger.error(f"Unexpected error processing line: {str(e)}")
+def dump_payload(payload: dict) -> bytes:
+    # Base64 images (bytes or bytearray) are spliced in raw, since they never need JSON escaping
+    fields = {key: value for key, value in payload.items() if key != "images"}
+    head = orjson.dumps(fields)[:-1]
+    if not payload["images"]:
+        return head + b',"images":[]}'
+    # A single join, so the multi-MB image data is copied into the body exactly once
+    return b"".join([head, b',"images":["', b'","'.join(payload["images"]), b'"]}'])
+
+async def process_image(image: UploadFile) -> tuple:
+    # Reading the spooled upload, hashing and JPEG encoding all block, keep them off the event loop
+    return await asyncio.to_thread(encode_image, image.file)
+
+async def iter_worker_messages(client: httpx.AsyncClient, worker_address: str, payload: dict):
+    # The worker separates its JSON messages with NUL bytes rather than newlines, so split
+    # the raw stream ourselves and hand each message on as soon as its terminator arrives
+    async with client.stream('POST', f"{worker_address}/worker_generate_stream", content=dump_payload(payload), headers=JSON_HEADERS, timeout=WORKER_TIMEOUT) as response:
+        response.raise_for_status()
+        buffer = bytearray()
+        start = 0
+        # No chunk_size: httpx would hold bytes back until a whole chunk had accumulated
+        async for chunk in response.aiter_bytes():
+            buffer += chunk
+            while (end := buffer.find(b'\x00', start)) != -1:
+                message = bytes(buffer[:end])
+                del buffer[:end + 1]
+                start = 0
+                if message.strip():
+                    yield message
+            # Bytes already searched hold no terminator, don't rescan them
+            start = len(buffer)
+        if buffer.strip():
+            yield bytes(buffer)
+
+def sse_event(text: str) -> str:
+    # Every line of a multi-line payload needs its own data: field; clients rejoin them with \n
+    return "".join(f"data: {line}\n" for line in SSE_LINE_BREAK.split(text)) + "\n"
+
+async def translate_stream(client: httpx.AsyncClient, worker_address: str, payload: dict, inst: str, cache_key: tuple):
+    # Finished sentences are translated in the background while the worker keeps generating.
+    # Each pending entry is (translation task, whitespace that followed the sentence), so
+    # paragraph breaks survive translation and the client can concatenate events verbatim.
+    pending = collections.deque()
+    translations = []
+    complete = True  # False once any sentence fails to translate, so the gap isn't cached
+    generated_text = ""
+    sent = 0  # Length of generated_text already handed to the translator
+    try:
+        async with contextlib.aclosing(iter_worker_messages(client, worker_address, payload)) as messages:
+            async for message in messages:
+                try:
+                    data = orjson.loads(message)
+                except orjson.JSONDecodeError:
+                    logger.warning(f"Failed to parse JSON: {message}")
+                    continue
+                if data.get("error_code", 0) != 0:
+                    logger.error(f"Received error from worker: {data}")
+                    yield sse_event(f"Error: {data.get('text', 'Unknown error')}")
+                    yield "data: [DONE]\n\n"
+                    return
+
+                # Each message carries the cumulative text, so only the latest one is kept
+                generated_text = data.get("text", generated_text).removeprefix(inst)
+                end = sent
+                for match in SENTENCE_END.finditer(generated_text, sent):
+                    end = match.end()
+                if end > sent:
+                    sentence = generated_text[sent:end]
+                    separator = sentence[len(sentence.rstrip()):]
+                    pending.append((asyncio.create_task(translate_text_cached(sentence.strip())), separator))
+                    sent = end
+
+                while pending and pending[0][0].done():
+                    task, separator = pending.popleft()
+                    translated_text = task.result()
+                    if translated_text is None:
+                        logger.warning("Translation returned no text for a sentence")
+                        complete = False
+                    else:
+                        translations.append(translated_text + separator)
+                        yield sse_event(translations[-1])
+
+        if not generated_text.strip():
+            logger.warning("No valid 'text' field found in the response")
+            yield sse_event("Error: No valid text found in worker response")
             yield "data: [DONE]\n\n"
+            return
+
+        rest = generated_text[sent:].strip()
+        if rest:
+            pending.append((asyncio.create_task(translate_text_cached(rest)), ""))
+        while pending:
+            task, separator = pending.popleft()
+            translated_text = await task
+            if translated_text is None:
+                logger.warning("Translation returned no text for a sentence")
+                complete = False
+            else:
+                translations.append(translated_text + separator)
+                yield sse_event(translations[-1])
+
+        logger.info(f"Final generated text: {generated_text.strip()}")
+        if complete:
+            async with cache_lock:
+                response_cache[cache_key] = tuple(translations)
+        yield "data: [DONE]\n\n"
+
+    except httpx.ConnectError as e:
+        logger.error(f"Failed to connect to worker: {str(e)}")
+        # The cached worker may have gone away, resolve it again on the next request
+        worker_addresses.pop(MODEL_NAME, None)
+        yield sse_event("Error: Service unavailable due to network error")
+        yield "data: [DONE]\n\n"
+    except httpx.TimeoutException:
+        logger.error("Request to worker timed out")
+        yield sse_event("Error: Worker request timed out")
+        yield "data: [DONE]\n\n"
+    except httpx.RequestError as e:
+        logger.error(f"Network error occurred: {str(e)}")
+        yield sse_event("Error: Service unavailable due to network error")
+        yield "data: [DONE]\n\n"
+    except Exception as e:
+        logger.exception("Unexpected error while streaming generate response")
+        yield sse_event(f"Error: An unexpected error occurred: {str(e)}")
+        yield "data: [DONE]\n\n"
+    finally:
+        # Don't leave translations running if the client went away mid-stream
+        for task, _ in pending:
+            task.cancel()
+
+async def cached_stream(translations: tuple):
+    # Replay the same events a fresh run produced
+    for translated_text in translations:
+        yield sse_event(translated_text)
+    yield "data: [DONE]\n\n"
 
 @app.get("/")
 async def root():
@@ -112,70 +323,25 @@ async def generate(image: UploadFile = File(...), prompt: str = Form(...)):
     try:
         image_hash, base64_image = await process_image(image)
         logger.info(f"Processed image. Hash: {image_hash}")
+
+        cache_key = (image_hash, prompt)
+        async with cache_lock:
+            cached_translations = response_cache.get(cache_key)
+        if cached_translations is not None:
+            logger.info(f"Cache hit for image {image_hash}")
+            return StreamingResponse(cached_stream(cached_translations), media_type="text/event-stream")
         
-        model_name = "llava-med-v1.5-mistral-7b"
-        worker_address = await get_worker_address(model_name)
+        worker_address = await get_worker_address(MODEL_NAME)
         logger.info(f"Got worker address: {worker_address}")
         
-        payload = {
-            "model": model_name,
-            "prompt": f"[INST] <image>\n{prompt} [/INST]",
-            "temperature": 0.2,
-            "top_p": 0.7,
-            "max_new_tokens": 512,
-            "stop": "</s>",
-            "images": [base64_image]
-        }
+        inst = f"[INST] <image>\n{prompt} [/INST]"
+        payload = {**BASE_PAYLOAD, "prompt": inst, "images": [base64_image]}
         logger.debug(f"Prepared payload: {payload}")
 
-        async with httpx.AsyncClient() as client:
-            logger.info(f"Sending request to worker at {worker_address}")
-            response = await client.post(f"{worker_address}/worker_generate_stream", json=payload, timeout=WORKER_TIMEOUT)
-            
-            response.raise_for_status()
-
-            chunks = []
-            async for chunk in response.aiter_bytes():
-                chunks.append(chunk)
-
-            if not chunks:
-                logger.warning("Received empty response from worker")
-                raise HTTPException(status_code=500, detail="Worker returned empty response")
-
-            # Process the last chunk
-            last_chunk = chunks[-1]
-            chunk_str = last_chunk.decode('utf-8')
-            json_objects = chunk_str.split('\u0000')
-            full_text = ""
-
-            for json_str in reversed(json_objects):
-                if json_str.strip():
-                    try:
-                        data = json.loads(json_str)
-                        if "text" in data:
-                            full_text = data["text"]
-                            break  # Exit loop after finding the last valid JSON with 'text'
-                    except json.JSONDecodeError:
-                        logger.warning(f"Failed to parse JSON: {json_str}")
-
-            if not full_text:
-                logger.warning("No valid 'text' field found in the response")
-                raise HTTPException(status_code=500, detail="No valid text found in worker response")
-            
-            # Clean up the response
-            generated_text = full_text.replace(f"[INST] <image>\n{prompt} [/INST]", "").strip()
-            translated_text = translate_text(generated_text)
-            
-            logger.info(f"Final generated text: {generated_text}")
-            
-            return {"generated_text": translated_text}
+        client = app.state.http
+        logger.info(f"Sending request to worker at {worker_address}")
+        return StreamingResponse(translate_stream(client, worker_address, payload, inst, cache_key), media_type="text/event-stream")
 
-    except httpx.RequestError as e:
-        logger.error(f"Network error occurred: {str(e)}")
-        raise HTTPException(status_code=503, detail="Service unavailable due to network error")
-    except httpx.TimeoutException:
-        logger.error("Request to worker timed out")
-        raise HTTPException(status_code=504, detail="Worker request timed out")
     except Exception as e:
         logger.exception("Unexpected error in generate endpoint")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
@@ -2,12 +2,16 @@ from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
 import base64
-import io
-from PIL import Image
-import json
-import hashlib
+import simplejpeg
+import cv2
+import numpy as np
+import orjson
+import xxhash
 from typing import List
 import logging
+import time
+import asyncio
+import contextlib
 
 app = FastAPI()
 
@@ -26,28 +30,157 @@ app.add_middleware(
 
 CONTROLLER_ADDRESS = "http://localhost:10000"  # Replace with your controller's address
 WORKER_TIMEOUT = 60.0  # Increased timeout
+CONTROLLER_TIMEOUT = 5.0  # Address lookups are quick; keep a hung controller from stalling requests
+MODEL_NAME = "llava-med-v1.5-mistral-7b"
+# Generation settings shared by every worker request; per-request fields are merged in
+BASE_PAYLOAD = {
+    "model": MODEL_NAME,
+    "temperature": 0.2,
+    "top_p": 0.7,
+    "max_new_tokens": 512,
+    "stop": "</s>",
+}
+JSON_HEADERS = {"Content-Type": "application/json"}  # Payloads are pre-serialized with orjson
+UPLOAD_CHUNK_BYTES = 65535  # Multiple of 3, so each chunk base64-encodes without padding
+WORKER_ADDRESS_TTL = 30.0  # Seconds to reuse a worker address before asking the controller again
+
+# model -> (worker address, time it was resolved)
+worker_addresses = {}
+worker_address_lock = asyncio.Lock()
+
+@app.on_event("startup")
+async def startup():
+    # Shared client so worker/controller connections are kept alive between requests
+    app.state.http = httpx.AsyncClient(
+        timeout=httpx.Timeout(WORKER_TIMEOUT),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=300),
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.http.aclose()
 
 async def get_worker_address(model: str) -> str:
-    async with httpx.AsyncClient() as client:
+    cached = worker_addresses.get(model)
+    if cached is not None and time.monotonic() - cached[1] < WORKER_ADDRESS_TTL:
+        return cached[0]
+
+    # The lock makes concurrent callers on a cache miss share a single controller refresh
+    async with worker_address_lock:
+        cached = worker_addresses.get(model)
+        if cached is not None and time.monotonic() - cached[1] < WORKER_ADDRESS_TTL:
+            return cached[0]
+
+        client = app.state.http
         try:
-            response = await client.post(f"{CONTROLLER_ADDRESS}/get_worker_address", json={"model": model})
+            response = await client.post(f"{CONTROLLER_ADDRESS}/get_worker_address", json={"model": model}, timeout=CONTROLLER_TIMEOUT)
             response.raise_for_status()
-            return response.json()["address"]
+            address = response.json()["address"]
         except httpx.HTTPError as e:
             logger.error(f"Failed to get worker address: {str(e)}")
             raise HTTPException(status_code=503, detail="Failed to get worker address from controller")
 
-async def process_image(image: UploadFile) -> tuple:
-    image_content = await image.read()
-    image = Image.open(io.BytesIO(image_content)).convert('RGB')
-    image_hash = hashlib.md5(image.tobytes()).hexdigest()
+        worker_addresses[model] = (address, time.monotonic())
+        return address
+
+def jpeg_colorspace(head: bytes):
+    # None for non-JPEG uploads, or when the header did not fit in the first chunk
+    if head[:3] != b'\xff\xd8\xff':
+        return None
+    try:
+        return simplejpeg.decode_jpeg_header(head)[2]
+    except ValueError:
+        return None
+
+def encode_image(image_file) -> tuple:
+    # Hash the compressed upload rather than the decoded pixel buffer
+    hasher = xxhash.xxh3_128()
+    head = image_file.read(UPLOAD_CHUNK_BYTES)
+    hasher.update(head)
+    colorspace = jpeg_colorspace(head)
+    if colorspace in ('YCbCr', 'RGB'):
+        # Already an RGB JPEG: the worker accepts it as-is, so stream it through the hash and
+        # base64 encoder rather than reading the raw upload into memory first
+        base64_image = bytearray(base64.b64encode(head))
+        while chunk := image_file.read(UPLOAD_CHUNK_BYTES):
+            hasher.update(chunk)
+            base64_image += base64.b64encode(chunk)
+        # Returned as the bytearray itself, converting to bytes would copy the whole blob again
+        return hasher.hexdigest(), base64_image
+
+    rest = image_file.read()
+    hasher.update(rest)
+    image_hash = hasher.hexdigest()
+    image_content = head + rest
+
+    # The worker expects a 3-channel RGB image, so anything else is decoded and re-encoded
+    if colorspace == 'Gray':
+        # Grayscale JPEGs (most X-ray/CT images) are expanded to RGB by simplejpeg directly
+        rgb = simplejpeg.decode_jpeg(image_content, colorspace='RGB')
+    else:
+        # CMYK JPEG, PNG and other formats go through OpenCV, which decodes to BGR. EXIF
+        # orientation is ignored, as on the passthrough path, so no upload gets rotated
+        bgr = cv2.imdecode(np.frombuffer(image_content, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if bgr is None:
+            raise ValueError("Unsupported image format")
+        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
     
-    buffer = io.BytesIO()
-    image.save(buffer, format="JPEG")
-    base64_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    jpeg_bytes = simplejpeg.encode_jpeg(rgb, quality=85, colorspace='RGB')
+    base64_image = base64.b64encode(jpeg_bytes)
     
     return image_hash, base64_image
 
+def dump_payload(payload: dict) -> bytes:
+    # Base64 images (bytes or bytearray) are spliced in raw, since they never need JSON escaping
+    fields = {key: value for key, value in payload.items() if key != "images"}
+    head = orjson.dumps(fields)[:-1]
+    if not payload["images"]:
+        return head + b',"images":[]}'
+    # A single join, so the multi-MB image data is copied into the body exactly once
+    return b"".join([head, b',"images":["', b'","'.join(payload["images"]), b'"]}'])
+
+async def process_image(image: UploadFile) -> tuple:
+    # Reading the spooled upload, hashing and JPEG encoding all block, keep them off the event loop
+    return await asyncio.to_thread(encode_image, image.file)
+
+async def iter_worker_messages(client: httpx.AsyncClient, worker_address: str, payload: dict):
+    # The worker separates its JSON messages with NUL bytes rather than newlines, so split
+    # the raw stream ourselves and hand each message on as soon as its terminator arrives
+    async with client.stream('POST', f"{worker_address}/worker_generate_stream", content=dump_payload(payload), headers=JSON_HEADERS, timeout=WORKER_TIMEOUT) as response:
+        response.raise_for_status()
+        buffer = bytearray()
+        start = 0
+        # No chunk_size: httpx would hold bytes back until a whole chunk had accumulated
+        async for chunk in response.aiter_bytes():
+            buffer += chunk
+            while (end := buffer.find(b'\x00', start)) != -1:
+                message = bytes(buffer[:end])
+                del buffer[:end + 1]
+                start = 0
+                if message.strip():
+                    yield message
+            # Bytes already searched hold no terminator, don't rescan them
+            start = len(buffer)
+        if buffer.strip():
+            yield bytes(buffer)
+
+async def collect_worker_text(client: httpx.AsyncClient, worker_address: str, payload: dict) -> str:
+    # Each message carries the cumulative text, so only the latest one is kept
+    full_text = ""
+    async with contextlib.aclosing(iter_worker_messages(client, worker_address, payload)) as messages:
+        async for message in messages:
+            logger.debug(f"Received message from worker: {message}")
+            try:
+                data = orjson.loads(message)
+            except orjson.JSONDecodeError:
+                logger.warning(f"Failed to parse JSON: {message}")
+                continue
+            if data.get("error_code", 0) != 0:
+                logger.error(f"Received error from worker: {data}")
+                continue
+            full_text = data.get("text", full_text)
+    return full_text
+
 @app.get("/")
 async def root():
     return {"health_check": "OK", "model_version": "v1.0"}
@@ -58,82 +191,32 @@ async def generate(image: UploadFile = File(...), prompt: str = Form(...)):
         image_hash, base64_image = await process_image(image)
         logger.info(f"Processed image. Hash: {image_hash}")
         
-        model_name = "llava-med-v1.5-mistral-7b"
-        worker_address = await get_worker_address(model_name)
+        worker_address = await get_worker_address(MODEL_NAME)
         logger.info(f"Got worker address: {worker_address}")
         
-        payload = {
-            "model": model_name,
-            "prompt": f"[INST] <image>\n{prompt} [/INST]",
-            "temperature": 0.2,
-            "top_p": 0.7,
-            "max_new_tokens": 512,
-            "stop": "</s>",
-            "images": [base64_image]
-        }
+        inst = f"[INST] <image>\n{prompt} [/INST]"
+        payload = {**BASE_PAYLOAD, "prompt": inst, "images": [base64_image]}
         logger.debug(f"Prepared payload: {payload}")
 
-        async with httpx.AsyncClient() as client:
-            logger.info(f"Sending request to worker at {worker_address}")
-            response = await client.post(f"{worker_address}/worker_generate_stream", json=payload, timeout=WORKER_TIMEOUT)
-            
-            response.raise_for_status()
+        client = app.state.http
+        logger.info(f"Sending request to worker at {worker_address}")
+        full_text = await collect_worker_text(client, worker_address, payload)
+
+        if not full_text:
+            logger.warning("Received empty response from worker")
+            raise HTTPException(status_code=500, detail="Worker returned empty response")
 
-            full_response = []
-            async for line in response.aiter_lines():
-                if line:
-                    logger.debug(f"Received line from worker: {line}")
-                    try:
-                        # First, try to parse as JSON
-                        data = json.loads(line)
-                        if "error_code" in data:
-                            if data["error_code"] == 0:
-                                if "text" in data:
-                                    full_response.append(data["text"].strip())
-                                    logger.info(f"Appended response chunk: {data['text'].strip()}")
-                                else:
-                                    logger.warning(f"Received JSON data without 'text' field: {data}")
-                            else:
-                                logger.error(f"Received error from worker: {data}")
-                        else:
-                            logger.warning(f"Received JSON data without 'error_code' field: {data}")
-                    except json.JSONDecodeError:
-                        # If it's not JSON, treat the entire line as text
-                        logger.warning(f"Received non-JSON line, treating as raw text: {line}")
-                        full_response.append(line.strip())
-                    except Exception as e:
-                        logger.error(f"Unexpected error processing line: {str(e)}")
-                    finally:
-                        logger.debug("Continuing to next line")
-
-            complete_response = "".join(full_response)
-            
-            if not complete_response:
-                logger.warning("Received empty response from worker")
-                raise HTTPException(status_code=500, detail="Worker returned empty response")
-            
-                        # Remove the trailing error code and quotation marks
-            if complete_response.endswith('", "error_code": 0}'):
-                generated_text = complete_response[:-len('", "error_code": 0}')]
-            else:
-                generated_text = complete_response
-
-            # Remove any remaining trailing quotation marks
-            generated_text = generated_text.rstrip('"')
-
-            logger.info(f"Final generated text: {generated_text}")
-            
-            # Extract the generated text by removing the instruction
-            instruction_end = complete_response.rfind("[/INST]")
-            if instruction_end != -1:
-                generated_text = complete_response[instruction_end + 7:].strip()
-            else:
-                generated_text = complete_response.strip()
-            
-            logger.info(f"Final generated text: {generated_text}")
-            
-            return {"generated_text": generated_text}
+        generated_text = full_text.removeprefix(inst).strip()
+        
+        logger.info(f"Final generated text: {generated_text}")
+        
+        return {"generated_text": generated_text}
     
+    except httpx.ConnectError as e:
+        logger.error(f"Failed to connect to worker: {str(e)}")
+        # The cached worker may have gone away, resolve it again on the next request
+        worker_addresses.pop(MODEL_NAME, None)
+        raise HTTPException(status_code=503, detail="Service unavailable due to network error")
     except httpx.RequestError as e:
         logger.error(f"Network error occurred: {str(e)}")
         raise HTTPException(status_code=503, detail="Service unavailable due to network error")
@@ -147,8 +230,7 @@ async def generate(image: UploadFile = File(...), prompt: str = Form(...)):
 @app.post("/chat")
 async def chat(messages: List[dict], images: List[UploadFile] = File(None)):
     try:
-        model_name = "llava-med-v1.5-mistral-7b"
-        worker_address = await get_worker_address(model_name)
+        worker_address = await get_worker_address(MODEL_NAME)
         
         processed_images = []
         if images:
@@ -156,56 +238,22 @@ async def chat(messages: List[dict], images: List[UploadFile] = File(None)):
                 _, base64_image = await process_image(image)
                 processed_images.append(base64_image)
         
-        payload = {
-            "model": model_name,
-            "messages": messages,
-            "temperature": 0.2,
-            "top_p": 0.7,
-            "max_new_tokens": 512,
-            "stop": "</s>",
-            "images": processed_images
-        }
-
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{worker_address}/worker_generate_stream", json=payload, timeout=WORKER_TIMEOUT)
-            
-            response.raise_for_status()
+        payload = {**BASE_PAYLOAD, "messages": messages, "images": processed_images}
 
-            full_response = []
-            async for line in response.aiter_lines():
-                if line:
-                    logger.debug(f"Received line from worker: {line}")
-                    try:
-                        # First, try to parse as JSON
-                        data = json.loads(line)
-                        if "error_code" in data:
-                            if data["error_code"] == 0:
-                                if "text" in data:
-                                    full_response.append(data["text"].strip())
-                                    logger.info(f"Appended response chunk: {data['text'].strip()}")
-                                else:
-                                    logger.warning(f"Received JSON data without 'text' field: {data}")
-                            else:
-                                logger.error(f"Received error from worker: {data}")
-                        else:
-                            logger.warning(f"Received JSON data without 'error_code' field: {data}")
-                    except json.JSONDecodeError:
-                        # If it's not JSON, treat the entire line as text
-                        logger.warning(f"Received non-JSON line, treating as raw text: {line}")
-                        full_response.append(line.strip())
-                    except Exception as e:
-                        logger.error(f"Unexpected error processing line: {str(e)}")
-                    finally:
-                        logger.debug("Continuing to next line")
-
-            complete_response = "".join(full_response)
-            
-            if not complete_response:
-                logger.warning("Received empty response from worker")
-                raise HTTPException(status_code=500, detail="Worker returned empty response")
-
-            return {"generated_text": complete_response}
+        client = app.state.http
+        full_text = await collect_worker_text(client, worker_address, payload)
 
+        if not full_text:
+            logger.warning("Received empty response from worker")
+            raise HTTPException(status_code=500, detail="Worker returned empty response")
+
+        return {"generated_text": full_text.strip()}
+
+    except httpx.ConnectError as e:
+        logger.error(f"Failed to connect to worker: {str(e)}")
+        # The cached worker may have gone away, resolve it again on the next request
+        worker_addresses.pop(MODEL_NAME, None)
+        raise HTTPException(status_code=503, detail="Service unavailable due to network error")
     except httpx.RequestError as e:
         logger.error(f"Network error occurred: {str(e)}")
         raise HTTPException(status_code=503, detail="Service unavailable due to network error")
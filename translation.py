@@ -2,14 +2,15 @@
 from google.cloud import translate
 
 
-# Initialize Translation client
+# Initialize Translation client once; it owns the gRPC channel and credentials
+client = translate.TranslationServiceClient()
+
+
 def translate_text(
     text: str = "YOUR_TEXT_TO_TRANSLATE", project_id: str = "apt-market-430913-t8"
 ) -> translate.TranslationServiceClient:
     """Translating Text."""
 
-    client = translate.TranslationServiceClient()
-
     location = "global"
 
     parent = f"projects/{project_id}/locations/{location}"